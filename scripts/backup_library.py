@@ -1,8 +1,33 @@
 import os
+import sys
 import zipfile
 import datetime
 import shutil
 import hashlib
+import heapq
+import zlib
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    # Optional: python-isal (`pip install isal`) is a drop-in zlib replacement
+    # built on ISA-L, typically 2-3x faster at the same deflate level.
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+if isal_zlib is not None:
+    # zipfile looks these up at call time, so swapping them is enough
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+    zlib = isal_zlib
+
+try:
+    # Optional: blake3 (`pip install blake3`) hashes the fingerprint much
+    # faster than sha256. The fingerprint is only ever compared with itself.
+    from blake3 import blake3 as _fingerprint_hasher
+except ImportError:
+    _fingerprint_hasher = hashlib.sha256
 
 # === CONFIG ===
 
@@ -13,55 +38,184 @@ LIBRARIES = {
 
 BACKUP_DIR = r"C:\Users\user\calibrebackups"
 
-# How many "recent" backups to keep (non-monthly), per library
+# How many "recent" full backups to keep (non-monthly), per library.
+# Delta backups built on top of a kept full backup are kept with it.
 MAX_RECENT_BACKUPS = 1
 
+# How many delta backups (changed files only) to chain onto a full backup
+# before taking a fresh full one
+MAX_DELTA_BACKUPS = 6
+
 # How many monthly snapshots to keep (per library)
 MAX_MONTHLY_SNAPSHOTS = 12  # 1 year of monthlies
 
+# Already-compressed formats are stored as-is; recompressing them burns CPU
+# for next to no space saving. Everything else (metadata.db, .opf, ...) is
+# compressed with COMPRESSION.
+STORED_EXTENSIONS = {
+    ".epub", ".cbz", ".cbr", ".cb7", ".mobi", ".azw", ".azw3", ".kfx", ".pdf",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".m4a", ".m4b", ".mp4",
+    ".zip", ".rar", ".7z",
+}
+
+# "deflate" works with any unzip tool. "zstd" (Zstandard) compresses
+# metadata.db noticeably better and faster, but both this machine and the
+# restore machine need Python 3.14+ to read/write it.
+COMPRESSION = "deflate"
+DEFLATE_LEVEL = 1  # keep within 0-3 if isal is installed
+ZSTD_LEVEL = 3
+
+# Read buffer used when copying files into a backup zip
+COPY_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+# Fingerprint entries are buffered up to this size per hasher.update() call
+HASH_BATCH_SIZE = 1 << 20  # 1 MiB
+
+# Compressible files are compressed on this many threads in parallel.
+# At most COMPRESS_WINDOW results are in flight at once, and files larger
+# than PARALLEL_COMPRESS_MAX_SIZE are streamed on the main thread instead,
+# so memory use stays bounded.
+COMPRESS_WORKERS = os.cpu_count() or 1
+COMPRESS_WINDOW = 2 * COMPRESS_WORKERS
+PARALLEL_COMPRESS_MAX_SIZE = 16 << 20  # 16 MiB
+
+# How many threads to use when scanning a library for changes
+SCAN_WORKERS = 8
+
+# Name of the manifest stored inside every backup zip
+MANIFEST_NAME = "MANIFEST.json"
+
 
 def ensure_backup_dir():
     os.makedirs(BACKUP_DIR, exist_ok=True)
 
 
-def compute_library_fingerprint(library_dir: str) -> str:
+def write_atomic(path: str, data: bytes):
+    """
+    Write data to path via a temp file + os.replace, so a crash mid-write
+    never leaves a truncated state file behind.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# On POSIX, scandir() accepts a directory fd; DirEntry.stat() then does an
+# fstatat() relative to it (like os.fwalk) instead of re-resolving the path.
+_SCAN_BY_FD = os.scandir in os.supports_fd
+
+
+def _open_scandir(dir_path: str):
+    """Return (scandir iterator, dir fd or None) for dir_path."""
+    if not _SCAN_BY_FD:
+        return os.scandir(dir_path), None
+    dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        return os.scandir(dir_fd), dir_fd
+    except OSError:
+        os.close(dir_fd)
+        raise
+
+
+def _scan_dir(dir_path: str, rel_dir: str):
+    """
+    Scan a single directory with os.scandir.
+    Returns ([(rel_path, size, mtime_ns, inode), ...], [(sub_path, sub_rel), ...]).
+    The stat data comes straight from the directory listing where the OS
+    provides it (Windows), or from fstatat() on the open directory (POSIX),
+    instead of a stat() by full path per file.
+    """
+    files = []
+    subdirs = []
+    try:
+        it, dir_fd = _open_scandir(dir_path)
+    except OSError:
+        # Directory disappeared after its parent was scanned, or can't be
+        # read; skip it (as os.walk does)
+        return files, subdirs
+    try:
+        with it:
+            for entry in it:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((os.path.join(dir_path, entry.name), rel_path))
+                    continue
+                if not entry.is_file():
+                    # Sockets, broken symlinks, etc. aren't part of the library
+                    continue
+                try:
+                    # Symlinked files are backed up (and restored) as the
+                    # file they point to, so record the target's stat
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # File disappeared between scandir and stat; skip it
+                    continue
+                files.append((rel_path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return files, subdirs
+
+
+def scan_library(library_dir: str) -> list:
+    """
+    Walk the library, scanning directories in parallel on a thread pool
+    (stat latency dominates on slow disks and network shares).
+    Returns [(rel_path, size, mtime_ns, inode), ...] sorted by rel_path.
     """
-    Build a fingerprint of the library based on file paths, sizes, and mtimes.
+    results = []
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        pending = {pool.submit(_scan_dir, library_dir, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                results.extend(files)
+                for sub_path, sub_rel in subdirs:
+                    pending.add(pool.submit(_scan_dir, sub_path, sub_rel))
+
+    # Sort to make the fingerprint deterministic
+    results.sort()
+    return results
+
+
+def compute_library_fingerprint(library_dir: str, entries: list = None) -> str:
+    """
+    Build a fingerprint of the library based on file paths, sizes, mtimes
+    (full nanosecond resolution) and inodes.
     We DON'T hash full file contents to keep it fast.
+    Pass entries to reuse an existing scan_library() result instead of
+    walking the library again.
     """
-    hasher = hashlib.sha256()
-
-    for root, dirs, files in os.walk(library_dir):
-        # Sort to make traversal deterministic
-        dirs.sort()
-        files.sort()
-        for file in files:
-            full_path = os.path.join(root, file)
-            try:
-                stat = os.stat(full_path)
-            except FileNotFoundError:
-                # File disappeared between walk and stat; skip it
-                continue
-            rel_path = os.path.relpath(full_path, library_dir)
-            size = stat.st_size
-            mtime = int(stat.st_mtime)
+    hasher = _fingerprint_hasher()
+    buf = bytearray()
+
+    if entries is None:
+        entries = scan_library(library_dir)
 
-            entry = f"{rel_path}|{size}|{mtime}\n"
-            hasher.update(entry.encode("utf-8"))
+    for rel_path, size, mtime_ns, ino in entries:
+        entry = f"{rel_path}|{size}|{mtime_ns}|{ino}\n".encode("utf-8")
+        # Entries are tiny; batch them to cut per-call overhead
+        buf += entry
+        if len(buf) >= HASH_BATCH_SIZE:
+            hasher.update(buf)
+            buf.clear()
+
+    hasher.update(buf)
 
     return hasher.hexdigest()
 
 
 def state_file_for_prefix(prefix: str) -> str:
-    return os.path.join(BACKUP_DIR, f"{prefix}_library_state.txt")
+    return os.path.join(BACKUP_DIR, f"{prefix}_library_state_v3.txt")
 
 
-def has_library_changed(prefix: str, library_dir: str) -> bool:
+def has_library_changed(prefix: str, current: str) -> bool:
     """
     Compare current fingerprint with last stored fingerprint.
     Returns True if changed or state file missing.
     """
-    current = compute_library_fingerprint(library_dir)
     state_path = state_file_for_prefix(prefix)
 
     if os.path.exists(state_path):
@@ -72,46 +226,352 @@ def has_library_changed(prefix: str, library_dir: str) -> bool:
             return False
 
     # Either no state file or fingerprint differs
-    with open(state_path, "w", encoding="utf-8") as f:
-        f.write(current)
     print(f"[{prefix}] Changes detected. Proceeding with backup.")
     return True
 
 
-def create_backup_zip(prefix, library_dir):
-    now = datetime.datetime.now()
+def write_library_state(prefix: str, fingerprint: str):
+    write_atomic(state_file_for_prefix(prefix), fingerprint.encode("utf-8"))
+
+
+def is_delta_backup(path: str) -> bool:
+    return os.path.basename(path).endswith("_delta.zip")
+
+
+def monthly_snapshot_path(prefix: str, now: datetime.datetime) -> str:
+    month_tag = now.strftime("%Y-%m")
+    return os.path.join(BACKUP_DIR, f"{prefix}_library_{month_tag}_monthly.zip")
+
+
+def find_latest_backup(prefix: str):
+    """Newest non-monthly backup (full or delta) for this prefix, or None."""
+    with os.scandir(BACKUP_DIR) as it:
+        candidates = [
+            e for e in it
+            if e.name.lower().endswith(".zip")
+            and e.name.startswith(f"{prefix}_library_")
+            and "_monthly" not in e.name
+            and e.is_file()
+        ]
+    if not candidates:
+        return None
+    # Lexicographic max is fine due to timestamp format
+    return max(candidates, key=lambda e: e.name).path
+
+
+def read_backup_manifest(backup_path: str):
+    """Read MANIFEST.json from a backup zip, or None if it has none."""
+    try:
+        with zipfile.ZipFile(backup_path, "r") as zf:
+            return json.loads(zf.read(MANIFEST_NAME))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def _is_stored(rel_path: str) -> bool:
+    return os.path.splitext(rel_path)[1].lower() in STORED_EXTENSIONS
+
+
+def compression_config_error():
+    """
+    Return a message describing what's wrong with COMPRESSION, or None if
+    it can be used on this Python.
+    """
+    if COMPRESSION not in ("deflate", "zstd"):
+        return f'COMPRESSION must be "deflate" or "zstd", not {COMPRESSION!r}'
+    if COMPRESSION == "zstd" and not hasattr(zipfile, "ZIP_ZSTANDARD"):
+        return 'COMPRESSION = "zstd" needs Python 3.14 or newer'
+    return None
+
+
+def _compression():
+    """
+    Return (compress_type, level, new_compressor) for compressible files,
+    per COMPRESSION (checked by main() via compression_config_error()).
+    new_compressor() returns an object with the usual compress(data) /
+    flush() interface producing the raw member data.
+    """
+    if COMPRESSION == "zstd":
+        from compression import zstd
+        return zipfile.ZIP_ZSTANDARD, ZSTD_LEVEL, lambda: zstd.ZstdCompressor(ZSTD_LEVEL)
+    return (
+        zipfile.ZIP_DEFLATED,
+        DEFLATE_LEVEL,
+        lambda: zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15),
+    )
+
+
+def _write_member(zf, full_path: str, rel_path: str):
+    """
+    Add one library file to the zip. Same as zf.write(), but copies with a
+    COPY_BUFFER_SIZE buffer instead of zipfile's fixed 8 KiB one.
+    """
+    # Clamp pre-1980 mtimes instead of raising ValueError
+    zinfo = zipfile.ZipInfo.from_file(full_path, rel_path, strict_timestamps=False)
+    if _is_stored(rel_path):
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type, level, _ = _compression()
+        # zf.open() takes the level from the ZipInfo, as zf.write() does
+        zinfo._compresslevel = level
+
+    with open(full_path, "rb", buffering=0) as src, zf.open(zinfo, "w") as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def _compress_member(full_path: str, rel_path: str):
+    """
+    Compress one file into memory (runs on a worker thread).
+    Returns (zinfo, data) ready for _write_precompressed().
+    """
+    zinfo = zipfile.ZipInfo.from_file(full_path, rel_path, strict_timestamps=False)
+    zinfo.compress_type, _, new_compressor = _compression()
+
+    compressor = new_compressor()
+    chunks = []
+    crc = 0
+    file_size = 0
+    with open(full_path, "rb", buffering=0) as src:
+        while True:
+            block = src.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            chunks.append(compressor.compress(block))
+    chunks.append(compressor.flush())
+    data = b"".join(chunks)
+
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def _write_precompressed(zf, zinfo, data: bytes):
+    """
+    Append an entry whose compressed data was already built by
+    _compress_member(). zipfile has no public API for this, so this does
+    what ZipFile.writestr() does internally, minus the compression step.
+    """
+    zinfo.flag_bits = 0
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = (
+        zinfo.file_size > zipfile.ZIP64_LIMIT
+        or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    )
+
+    zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _write_backup(zip_path, library_dir, entries, old_files, base, chain) -> int:
+    """
+    Write the backup zip for create_backup_zip(): every entry whose stat
+    differs from old_files, plus the manifest. Returns the files written.
+    """
+    files = {}
+    written = 0
+    with zipfile.ZipFile(
+        zip_path,
+        "w",
+        zipfile.ZIP_DEFLATED,
+        allowZip64=True,
+        strict_timestamps=False,
+    ) as zf, \
+            ThreadPoolExecutor(max_workers=COMPRESS_WORKERS) as pool:
+        # Compress small non-stored files on the pool, keeping a window of
+        # COMPRESS_WINDOW jobs ahead of the writer (in sorted order). The main
+        # thread streams stored files meanwhile and appends results in order.
+        parallel = [
+            rel_path for rel_path, size, mtime_ns, _ in entries
+            if old_files.get(rel_path) != [size, mtime_ns]
+            and size <= PARALLEL_COMPRESS_MAX_SIZE
+            and not _is_stored(rel_path)
+        ]
+        pending = iter(parallel)
+        parallel = set(parallel)
+        compressed = {}
+
+        def submit_next():
+            rel_path = next(pending, None)
+            if rel_path is not None:
+                full_path = os.path.join(library_dir, rel_path)
+                compressed[rel_path] = pool.submit(_compress_member, full_path, rel_path)
+
+        for _ in range(COMPRESS_WINDOW):
+            submit_next()
+
+        for rel_path, size, mtime_ns, _ in entries:
+            stat_key = [size, mtime_ns]
+            if old_files.get(rel_path) != stat_key:
+                full_path = os.path.join(library_dir, rel_path)
+                try:
+                    if rel_path in parallel:
+                        future = compressed.pop(rel_path)
+                        submit_next()
+                        _write_precompressed(zf, *future.result())
+                    else:
+                        _write_member(zf, full_path, rel_path)
+                except FileNotFoundError:
+                    # File disappeared since the scan; leave it out
+                    continue
+                written += 1
+            files[rel_path] = stat_key
+
+        manifest = {
+            "base": base,
+            "chain": chain,
+            "files": files,
+            "deleted": sorted(set(old_files) - set(files)),
+        }
+        zf.writestr(
+            MANIFEST_NAME,
+            json.dumps(manifest),
+            compress_type=zipfile.ZIP_DEFLATED,
+            compresslevel=DEFLATE_LEVEL,
+        )
+
+    return written
+
+
+def create_backup_zip(prefix, library_dir, entries, now=None):
+    """
+    Back up the library described by entries (from scan_library).
+
+    Normally this writes a delta zip holding only files that are new or
+    changed since the previous backup. A full backup is taken instead when
+    there is no usable previous backup, the delta chain is
+    MAX_DELTA_BACKUPS long, or this month has no monthly snapshot yet
+    (monthlies must be self-contained).
+
+    Every zip carries a MANIFEST.json with:
+      - base:    file name of the full backup a delta builds on (None if full)
+      - chain:   number of deltas since base (0 if full)
+      - files:   {rel_path: [size, mtime_ns]} for the whole library
+      - deleted: files removed since the previous backup
+    """
+    if now is None:
+        now = datetime.datetime.now()
     timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-    backup_name = f"{prefix}_library_{timestamp}.zip"
+
+    previous_path = find_latest_backup(prefix)
+    previous = read_backup_manifest(previous_path) if previous_path else None
+
+    full = (
+        previous is None
+        or previous["chain"] >= MAX_DELTA_BACKUPS
+        or (
+            previous["base"] is not None
+            and not os.path.exists(os.path.join(BACKUP_DIR, previous["base"]))
+        )
+        or not os.path.exists(monthly_snapshot_path(prefix, now))
+    )
+
+    if full:
+        backup_name = f"{prefix}_library_{timestamp}.zip"
+        base = None
+        chain = 0
+        old_files = {}
+    else:
+        backup_name = f"{prefix}_library_{timestamp}_delta.zip"
+        base = previous["base"] or os.path.basename(previous_path)
+        chain = previous["chain"] + 1
+        old_files = previous["files"]
     backup_path = os.path.join(BACKUP_DIR, backup_name)
 
-    print(f"[{prefix}] Creating backup: {backup_path}")
+    kind = "full" if full else "delta"
+    print(f"[{prefix}] Creating {kind} backup: {backup_path}")
+
+    # Write under a temp name and only move it into place once complete, so
+    # a failed run never leaves a partial zip that looks like a backup
+    tmp_path = backup_path + ".partial"
+    try:
+        written = _write_backup(tmp_path, library_dir, entries, old_files, base, chain)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, backup_path)
+
+    print(f"[{prefix}] Backup created ({written} files written).")
+    return backup_path
 
-    with zipfile.ZipFile(backup_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(library_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                rel_path = os.path.relpath(full_path, library_dir)
-                zf.write(full_path, rel_path)
 
-    print(f"[{prefix}] Backup created.")
-    return backup_path
+def _reflink(src: str, dst: str) -> bool:
+    """
+    Try a copy-on-write clone of src to dst (Linux FICLONE, macOS
+    clonefile). Returns False if the platform/filesystem can't do it.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    if sys.platform == "darwin":
+        import ctypes
+        try:
+            clonefile = ctypes.CDLL(None, use_errno=True).clonefile
+        except AttributeError:
+            return False
+        return clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+    return False
 
 
-def ensure_monthly_snapshot(prefix, latest_backup_path):
+def link_or_copy(src: str, dst: str) -> str:
+    """
+    Make dst a copy of src as cheaply as possible: a hardlink, else a
+    copy-on-write clone, else a real copy. Backups are never modified in
+    place (prune only deletes), so sharing the data is safe.
+    Returns which method was used.
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    if _reflink(src, dst):
+        return "reflink"
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def ensure_monthly_snapshot(prefix, latest_backup_path, now=None):
     """
     Keep one 'monthly' snapshot per calendar month per library:
     e.g. books_library_YYYY-MM_monthly.zip
          manga_library_YYYY-MM_monthly.zip
+    Only full backups are used, so every monthly restores on its own.
     """
-    now = datetime.datetime.now()
+    if now is None:
+        now = datetime.datetime.now()
     month_tag = now.strftime("%Y-%m")
-    monthly_name = f"{prefix}_library_{month_tag}_monthly.zip"
-    monthly_path = os.path.join(BACKUP_DIR, monthly_name)
+    monthly_path = monthly_snapshot_path(prefix, now)
 
     if not os.path.exists(monthly_path):
+        if is_delta_backup(latest_backup_path):
+            print(f"[{prefix}] Latest backup is a delta; not using it as a monthly snapshot.")
+            return
         print(f"[{prefix}] No monthly snapshot for {month_tag} found. Creating one...")
-        shutil.copy2(latest_backup_path, monthly_path)
-        print(f"[{prefix}] Monthly snapshot created: {monthly_path}")
+        method = link_or_copy(latest_backup_path, monthly_path)
+        print(f"[{prefix}] Monthly snapshot created ({method}): {monthly_path}")
     else:
         print(f"[{prefix}] Monthly snapshot for {month_tag} already exists. Skipping.")
 
@@ -120,37 +580,58 @@ def prune_backups_for_prefix(prefix):
     """
     Prune backups for a single library (prefix).
     Keeps:
-      - last MAX_RECENT_BACKUPS "recent" backups
+      - last MAX_RECENT_BACKUPS "recent" full backups, plus the deltas
+        built on top of them
       - last MAX_MONTHLY_SNAPSHOTS monthly backups
     """
-    all_files = [
-        f for f in os.listdir(BACKUP_DIR)
-        if f.lower().endswith(".zip") and f.startswith(f"{prefix}_library_")
-    ]
-    full_paths = [os.path.join(BACKUP_DIR, f) for f in all_files]
-
-    recent = [p for p in full_paths if "_monthly" not in os.path.basename(p)]
-    monthly = [p for p in full_paths if "_monthly" in os.path.basename(p)]
+    # One pass over the backup dir, keeping only the newest N of each kind
+    # in a min-heap; whatever gets pushed out is deleted straight away.
+    # Lexicographic order is fine due to timestamp format.
+    full_heap = []
+    monthly_heap = []
+    deltas = []
+
+    with os.scandir(BACKUP_DIR) as it:
+        for entry in it:
+            name = entry.name
+            if not (name.lower().endswith(".zip") and name.startswith(f"{prefix}_library_")):
+                continue
+            if not entry.is_file():
+                continue
 
-    recent.sort()
-    monthly.sort()
+            if "_monthly" in name:
+                heap, limit, label = monthly_heap, MAX_MONTHLY_SNAPSHOTS, "old monthly snapshot"
+            elif is_delta_backup(name):
+                deltas.append((name, entry.path))
+                continue
+            else:
+                heap, limit, label = full_heap, MAX_RECENT_BACKUPS, "old backup"
 
-    # Prune recent
-    if len(recent) > MAX_RECENT_BACKUPS:
-        to_delete = recent[:-MAX_RECENT_BACKUPS]
-        for path in to_delete:
-            print(f"[{prefix}] Deleting old backup: {path}")
-            os.remove(path)
+            item = (name, entry.path)
+            if len(heap) < limit:
+                heapq.heappush(heap, item)
+                continue
+            _, evicted_path = heapq.heappushpop(heap, item)
+            print(f"[{prefix}] Deleting {label}: {evicted_path}")
+            os.remove(evicted_path)
 
-    # Prune monthly
-    if len(monthly) > MAX_MONTHLY_SNAPSHOTS:
-        to_delete = monthly[:-MAX_MONTHLY_SNAPSHOTS]
-        for path in to_delete:
-            print(f"[{prefix}] Deleting old monthly snapshot: {path}")
-            os.remove(path)
+    # Deltas always build on the newest full backup before them, so any
+    # delta older than the oldest kept full backup is orphaned.
+    if full_heap:
+        oldest_kept = full_heap[0][0]
+        for name, path in sorted(deltas):
+            if name < oldest_kept:
+                print(f"[{prefix}] Deleting old backup: {path}")
+                os.remove(path)
 
 
 def main():
+    # Check before touching any state, so a bad setting can't fail mid-backup
+    error = compression_config_error()
+    if error:
+        print(f"ERROR: {error}")
+        return
+
     ensure_backup_dir()
 
     for prefix, library_dir in LIBRARIES.items():
@@ -158,12 +639,20 @@ def main():
             print(f"[{prefix}] WARNING: Library dir does not exist: {library_dir}, skipping.")
             continue
 
+        entries = scan_library(library_dir)
+        fingerprint = compute_library_fingerprint(library_dir, entries)
+
         # Only back up if something changed
-        if not has_library_changed(prefix, library_dir):
+        if not has_library_changed(prefix, fingerprint):
             continue
 
-        latest_backup = create_backup_zip(prefix, library_dir)
-        ensure_monthly_snapshot(prefix, latest_backup)
+        # One timestamp per run, so the backup and monthly snapshot agree
+        now = datetime.datetime.now()
+        latest_backup = create_backup_zip(prefix, library_dir, entries, now=now)
+        # Record the new state only once the backup is safely in place;
+        # a failed run is then simply retried next time
+        write_library_state(prefix, fingerprint)
+        ensure_monthly_snapshot(prefix, latest_backup, now=now)
         prune_backups_for_prefix(prefix)
 
     print("Backup routine complete for all libraries.")
@@ -1,9 +1,30 @@
 import os
+import json
 import zipfile
 import shutil
 import subprocess  # for stopping/starting Docker container
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    # Optional: python-isal (`pip install isal`) inflates ~2x faster than zlib
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+if isal_zlib is not None:
+    # zipfile looks these up at call time, so swapping them is enough
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+
+try:
+    # Optional: the Docker SDK (`pip install docker`) talks to the daemon
+    # directly instead of spawning the docker CLI for every call.
+    import docker
+except ImportError:
+    docker = None
+
 # === CONFIG (MAC) ===
 
 # Local Calibre libraries on this Mac, keyed by the same prefixes
@@ -24,13 +45,22 @@ LIBRARIES = {
 # Name suffix for the *local* "last restored state" files on this Mac.
 LOCAL_STATE_SUFFIX = "_library_last_restored_state.txt"
 
+# Name of the manifest stored inside every backup zip
+MANIFEST_NAME = "MANIFEST.json"
+
+# How many threads extract files from a backup zip in parallel
+EXTRACT_WORKERS = 4
+
 # Name of your Docker container running linuxserver/calibre
 DOCKER_CONTAINER_NAME = "calibre"
 
+# Seconds to wait for Calibre to shut down before Docker kills it
+DOCKER_STOP_TIMEOUT = 30
+
 
 def remote_state_file(prefix: str) -> str:
     """Path to the state file produced on your main PC."""
-    return os.path.join(BACKUP_DIR, f"{prefix}_library_state.txt")
+    return os.path.join(BACKUP_DIR, f"{prefix}_library_state_v3.txt")
 
 
 def local_state_file(prefix: str) -> str:
@@ -40,45 +70,101 @@ def local_state_file(prefix: str) -> str:
 
 def read_state(path: str):
     """Read a state file (hash) if it exists, else None."""
-    if not os.path.exists(path):
+    try:
+        return Path(path).read_text(encoding="utf-8").strip() or None
+    except FileNotFoundError:
         return None
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read().strip() or None
 
 
 def write_state(path: str, value: str):
+    """Write a state file atomically (temp file + os.replace)."""
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(value)
+    tmp_path = path + ".tmp"
+    Path(tmp_path).write_text(value, encoding="utf-8")
+    os.replace(tmp_path, path)
 
 
 def find_latest_non_monthly_backup(prefix: str):
     """
-    Find the newest non-monthly backup zip for this prefix.
+    Find the newest non-monthly backup zip (full or delta) for this prefix.
     Uses filename ordering, since they are of the form:
       {prefix}_library_YYYY-MM-DD_HH-MM-SS.zip
+      {prefix}_library_YYYY-MM-DD_HH-MM-SS_delta.zip
     """
     if not os.path.isdir(BACKUP_DIR):
         return None
 
-    candidates = []
-    for name in os.listdir(BACKUP_DIR):
-        if not name.endswith(".zip"):
-            continue
-        if not name.startswith(f"{prefix}_library_"):
-            continue
-        if "_monthly" in name:
-            # skip monthly snapshots
-            continue
-        candidates.append(name)
+    latest = None
+    with os.scandir(BACKUP_DIR) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith(".zip"):
+                continue
+            if not name.startswith(f"{prefix}_library_"):
+                continue
+            if "_monthly" in name:
+                # skip monthly snapshots
+                continue
+            # Lexicographic comparison is fine due to timestamp format
+            if latest is None or name > latest.name:
+                latest = entry
+
+    return latest.path if latest is not None else None
+
+
+def read_backup_manifest(backup_path: str):
+    """Read MANIFEST.json from a backup zip, or None if it has none."""
+    try:
+        with zipfile.ZipFile(backup_path, "r") as zf:
+            return json.loads(zf.read(MANIFEST_NAME))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
 
-    if not candidates:
+def find_backup_chain(prefix: str):
+    """
+    Return the zips needed to restore the newest backup, oldest first:
+    its full base backup followed by every delta up to and including it.
+    Returns None if no backup exists or the chain is incomplete (e.g. a
+    delta hasn't finished syncing yet).
+    """
+    latest = find_latest_non_monthly_backup(prefix)
+    if latest is None:
         return None
 
-    # Lexicographic sort is fine due to timestamp format
-    candidates.sort()
-    latest_name = candidates[-1]
-    return os.path.join(BACKUP_DIR, latest_name)
+    latest_name = os.path.basename(latest)
+    manifest = read_backup_manifest(latest)
+    if manifest is None:
+        # A delta is useless without its manifest, and a zip we can't open
+        # at all is most likely still syncing; never restore from either
+        if latest_name.endswith("_delta.zip") or not zipfile.is_zipfile(latest):
+            print(f"[{prefix}] Backup {latest_name} is unreadable.")
+            return None
+        # Old full backup from before manifests; stands alone
+        return [latest]
+    if manifest["base"] is None:
+        # Full backup; stands alone
+        return [latest]
+
+    base_name = manifest["base"]
+    with os.scandir(BACKUP_DIR) as it:
+        deltas = [
+            e for e in it
+            if e.name.startswith(f"{prefix}_library_")
+            and e.name.endswith("_delta.zip")
+            and base_name < e.name <= latest_name
+        ]
+    deltas.sort(key=lambda e: e.name)
+    base_path = os.path.join(BACKUP_DIR, base_name)
+    if (
+        not zipfile.is_zipfile(base_path)
+        or len(deltas) != manifest["chain"]
+        or not all(zipfile.is_zipfile(e.path) for e in deltas)
+    ):
+        print(f"[{prefix}] Backup chain for {latest_name} is incomplete.")
+        return None
+
+    return [base_path] + [e.path for e in deltas]
 
 
 def clear_directory(dir_path: str):
@@ -92,28 +178,185 @@ def clear_directory(dir_path: str):
             os.remove(full)
 
 
-def restore_library_from_backup(prefix: str, backup_path: str, library_dir: str):
-    print(f"[{prefix}] Restoring from backup: {backup_path}")
+def extract_members(backup_path: str, members: list, library_dir: str):
+    """
+    Extract members of backup_path into library_dir on a thread pool.
+    ZipFile isn't safe to share between threads, so each worker opens its
+    own handle on the archive.
+    """
+    # Create every target directory up front so workers never race on it
+    for info in members:
+        target = os.path.join(library_dir, *info.filename.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def extract(info):
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(backup_path, "r")
+            with handles_lock:
+                handles.append(zf)
+        zf.extract(info, library_dir)
+
+    try:
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+            # list() so any worker exception is raised here
+            list(pool.map(extract, members))
+    finally:
+        for zf in handles:
+            zf.close()
+
+
+def scan_local_library(dir_path: str, rel_dir: str = "") -> dict:
+    """Return {rel_path: [size, mtime_ns]} for every file under dir_path."""
+    files = {}
+    try:
+        it = os.scandir(dir_path)
+    except FileNotFoundError:
+        return files
+    with it:
+        for entry in it:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                files.update(scan_local_library(entry.path, rel_path))
+            else:
+                # Follow file symlinks, matching the stat the backup recorded
+                stat = entry.stat(follow_symlinks=entry.is_file())
+                files[rel_path] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def plan_restore(backup_chain: list, library_dir: str):
+    """
+    Compare the library on disk with the newest backup's manifest.
+    Returns (extract, delete, files):
+      - extract: {backup_path: [ZipInfo, ...]} for files that are missing or
+                 differ locally, each taken from the newest zip holding it
+      - delete:  local rel_paths that aren't in the backup
+      - files:   the manifest's {rel_path: [size, mtime_ns]}
+    Returns None if the newest backup has no manifest (old-style zip).
+    """
+    manifest = read_backup_manifest(backup_chain[-1])
+    if manifest is None:
+        return None
+
+    files = manifest["files"]
+    local = scan_local_library(library_dir)
+    needed = {rel for rel, stat_key in files.items() if local.get(rel) != stat_key}
+    delete = sorted(set(local) - set(files))
+
+    extract = {}
+    for backup_path in reversed(backup_chain):
+        if not needed:
+            break
+        with zipfile.ZipFile(backup_path, "r") as zf:
+            members = [i for i in zf.infolist() if i.filename in needed]
+        if members:
+            extract[backup_path] = members
+            needed.difference_update(i.filename for i in members)
+
+    return extract, delete, files
+
+
+def _remove_empty_parents(library_dir: str, rel_path: str):
+    """Remove directories left empty by deleting rel_path, up to library_dir."""
+    parts = rel_path.split("/")[:-1]
+    while parts:
+        try:
+            os.rmdir(os.path.join(library_dir, *parts))
+        except OSError:
+            # Not empty (or already gone)
+            return
+        parts.pop()
+
+
+def restore_library_from_backup(
+    prefix: str, backup_chain: list, library_dir: str, plan=None
+):
+    """
+    Bring library_dir in line with the newest backup.
+
+    With a plan from plan_restore(), only changed files are extracted and
+    files missing from the backup are deleted; everything else is left
+    alone. Without one (old-style zip), the directory is cleared and the
+    zip extracted in full.
+    """
+    print(f"[{prefix}] Restoring from backup: {backup_chain[-1]}")
     print(f"[{prefix}] Target library directory: {library_dir}")
 
-    # Ensure library directory exists and is empty
-    clear_directory(library_dir)
+    if plan is None:
+        # Ensure library directory exists and is empty
+        clear_directory(library_dir)
+        with zipfile.ZipFile(backup_chain[-1], "r") as zf:
+            members = zf.infolist()
+        extract_members(backup_chain[-1], members, library_dir)
+        print(f"[{prefix}] Restore complete.")
+        return
 
-    # Extract the zip into the library directory
-    with zipfile.ZipFile(backup_path, "r") as zf:
-        zf.extractall(library_dir)
+    extract, delete, files = plan
+
+    for rel_path in delete:
+        print(f"[{prefix}] Removing {rel_path}")
+        try:
+            os.remove(os.path.join(library_dir, rel_path))
+        except FileNotFoundError:
+            # Already gone (e.g. Calibre cleaned it up while shutting down)
+            pass
+        _remove_empty_parents(library_dir, rel_path)
+
+    for backup_path, members in extract.items():
+        print(f"[{prefix}] Extracting {len(members)} files from {os.path.basename(backup_path)}")
+        extract_members(backup_path, members, library_dir)
+        # zipfile doesn't restore mtimes; set them from the manifest so the
+        # next restore can tell these files are already up to date
+        for info in members:
+            mtime_ns = files[info.filename][1]
+            target = os.path.join(library_dir, info.filename)
+            os.utime(target, ns=(mtime_ns, mtime_ns))
 
     print(f"[{prefix}] Restore complete.")
 
 
 # ===== Docker container control helpers =====
 
+_docker_client = None
+
+
+def _get_calibre_container():
+    """Look up the Calibre container via the Docker SDK (None if missing)."""
+    global _docker_client
+    if _docker_client is None:
+        _docker_client = docker.from_env()
+    try:
+        return _docker_client.containers.get(DOCKER_CONTAINER_NAME)
+    except docker.errors.NotFound:
+        return None
+
+
 def stop_calibre_container():
-    """Stop the Docker container that runs Calibre."""
+    """Stop the Docker container that runs Calibre and wait until it has."""
     print(f"Stopping Docker container '{DOCKER_CONTAINER_NAME}' (if running)...")
+
+    if docker is not None:
+        try:
+            container = _get_calibre_container()
+            if container is None:
+                print(f"Docker container '{DOCKER_CONTAINER_NAME}' not found.")
+                return
+            # Blocks until the container has actually stopped
+            container.stop(timeout=DOCKER_STOP_TIMEOUT)
+        except docker.errors.DockerException as e:
+            print(f"WARNING: Could not stop Docker container: {e}")
+            return
+        print("Docker container stopped.")
+        return
+
     # `docker stop` returns non-zero if not running; that's fine.
     subprocess.run(
-        ["docker", "stop", DOCKER_CONTAINER_NAME],
+        ["docker", "stop", "-t", str(DOCKER_STOP_TIMEOUT), DOCKER_CONTAINER_NAME],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
     )
@@ -123,6 +366,20 @@ def stop_calibre_container():
 def start_calibre_container():
     """Start the Docker container that runs Calibre."""
     print(f"Starting Docker container '{DOCKER_CONTAINER_NAME}'...")
+
+    if docker is not None:
+        try:
+            container = _get_calibre_container()
+            if container is None:
+                print(f"Docker container '{DOCKER_CONTAINER_NAME}' not found.")
+                return
+            container.start()
+        except docker.errors.DockerException as e:
+            print(f"WARNING: Could not start Docker container: {e}")
+            return
+        print("Docker container started.")
+        return
+
     subprocess.run(
         ["docker", "start", DOCKER_CONTAINER_NAME],
         check=False
@@ -156,17 +413,27 @@ def main():
 
         print(f"[{prefix}] New backup detected (remote state != local state).")
 
+        backup_chain = find_backup_chain(prefix)
+        if backup_chain is None:
+            print(f"[{prefix}] No usable non-monthly backups found in {BACKUP_DIR}. Skipping.")
+            continue
+
+        plan = plan_restore(backup_chain, library_dir)
+        if plan is not None and not plan[0] and not plan[1]:
+            print(f"[{prefix}] Library already matches the latest backup.")
+            write_state(local_state_path, remote_state)
+            continue
+
         # First time we see a change across ANY library, stop Docker container
         if not any_restored:
             stop_calibre_container()
+            # The plan above only decided whether to stop Calibre; re-plan
+            # now that it can no longer write to the library.
+            if plan is not None:
+                plan = plan_restore(backup_chain, library_dir)
 
-        latest_backup = find_latest_non_monthly_backup(prefix)
-        if latest_backup is None:
-            print(f"[{prefix}] No non-monthly backups found in {BACKUP_DIR}. Skipping.")
-            continue
-
-        # Restore from latest backup
-        restore_library_from_backup(prefix, latest_backup, library_dir)
+        # Restore from latest backup (plus its base, if it's a delta)
+        restore_library_from_backup(prefix, backup_chain, library_dir, plan)
 
         # Update local "last restored" state to match remote
         write_state(local_state_path, remote_state)